@@ -1,70 +1,181 @@
 import asyncio
-import base64
 import json
 from argparse import ArgumentParser
-from enum import Enum, auto
-from typing import Any, AsyncIterator, Dict, List, Optional, Sequence
+from binascii import a2b_base64
+from enum import Enum
+from functools import lru_cache
+from types import MappingProxyType
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    ClassVar,
+    Dict,
+    Hashable,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
 
-import aiohttp_cors
 import numpy as np
 import strawberry
 from aiohttp import web
+from strawberry.aiohttp.handlers import HTTPHandler
 from strawberry.aiohttp.views import GraphQLView
+from strawberry.dataloader import DataLoader
+from strawberry.exceptions import MissingQueryError
+from strawberry.extensions import ValidationCache
+from strawberry.http import GraphQLRequestData, parse_request_data
+from strawberry.schema.exceptions import InvalidOperationTypeError
 from strawberry.subscriptions import GRAPHQL_TRANSPORT_WS_PROTOCOL, GRAPHQL_WS_PROTOCOL
 from strawberry.types import Info
+from strawberry.types.graphql import OperationType
 
 from .caplugin import CAPlugin
 from .device_config import ChannelConfig
-from .plugin import PluginStore
+from .plugin import Plugin, PluginStore, PutValue
 from .pvaplugin import PVAPlugin
 from .simplugin import SimPlugin
 from .types import Channel, ChannelValue
 
+try:
+    # Faster json decoding of put values if available
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Number of distinct queries to cache validation results for
+QUERY_CACHE_SIZE = 1024
+# Number of subscription updates that can be prepared ahead of the client
+SUBSCRIBE_BUFFER_SIZE = 16
+
 
 # Resolver dependencies
 class DeferredChannel:
+    # One is made per Channel in every response, so keep them small
+    __slots__ = ("id", "channel")
+    # {(event_loop, populate_key): task_populating_channel}
+    inflight: ClassVar[
+        Dict[Tuple[asyncio.AbstractEventLoop, Hashable], "asyncio.Task[Channel]"]
+    ] = {}
     id: str
-    lock: asyncio.Lock
-    channel: Optional[Channel] = None
+    channel: Optional[Channel]
+
+    def populate_key(self) -> Hashable:
+        """DeferredChannels with equal keys can share a populate_channel"""
+        return self.id
 
     async def populate_channel(self) -> Channel:
         raise NotImplementedError(self)
 
     async def get_channel(self) -> Channel:
         if self.channel is None:
-            async with self.lock:
-                # If channel is still None we should make it
-                if self.channel is None:
-                    self.channel = await self.populate_channel()
-        assert self.channel
+            # Only one populate_channel per key at a time, others wait on it.
+            # Keyed by loop too, as tasks can only be awaited in their own loop
+            loop = asyncio.get_running_loop()
+            key = (loop, self.populate_key())
+            task = self.inflight.get(key)
+            if task is None:
+                # In its own task so a cancelled waiter doesn't cancel the others
+                task = loop.create_task(self.populate_channel())
+                self.inflight[key] = task
+                task.add_done_callback(lambda t: self._populate_done(key, t))
+            self.channel = await asyncio.shield(task)
         return self.channel
 
+    @classmethod
+    def _populate_done(cls, key, task: "asyncio.Task[Channel]"):
+        del cls.inflight[key]
+        # Mark any exception as retrieved, in case every waiter was cancelled
+        if not task.cancelled():
+            task.exception()
+
 
 NO_CONFIG = ChannelConfig(name="")
 
 
 class GetChannel(DeferredChannel):
-    def __init__(self, channel_id: str, timeout: float, store: PluginStore):
+    __slots__ = ("plugin", "config", "pv", "timeout", "loader", "scope")
+
+    def __init__(
+        self,
+        channel_id: str,
+        timeout: float,
+        store: PluginStore,
+        loader: "DataLoader[GetChannel, Channel]",
+        scope: Hashable = None,
+    ):
+        self.channel = None
+        self.loader = loader
+        # Only GetChannels with the same scope share a get
+        self.scope = scope
         self.plugin, self.config, self.id = store.plugin_config_id(channel_id)
         # Remove the transport prefix from the read pv
-        self.pv = store.transport_pv(self.config.read_pv or self.config.write_pv)[1]
+        self.pv = store.read_transport_pv(self.config)[1]
         self.timeout = timeout
-        self.lock = asyncio.Lock()
+
+    def populate_key(self) -> Hashable:
+        # So a request never fails with a shorter timeout from another request
+        return (self.id, self.timeout, self.scope)
 
     async def populate_channel(self) -> Channel:
-        channel = await self.plugin.get_channel(self.pv, self.timeout, self.config)
+        # Batched with the other GetChannels in this request
+        channel = await self.loader.load(self)
         return channel
 
 
 class SubscribeChannel(DeferredChannel):
+    __slots__ = ("value",)
+
     def __init__(self, channel_id: str, channel: Channel):
         self.id = channel_id
         self.channel = channel
+        # Prepared ahead of the client asking for it
+        self.value = channel.get_value()
+
+
+async def load_channels(
+    get_channels: List[GetChannel],
+) -> List[Union[Channel, BaseException]]:
+    """Load function for a DataLoader of GetChannels, making one get_channels
+    call per plugin and timeout"""
+    # {(plugin, timeout): [index_into_get_channels]}
+    groups: Dict[Tuple[Plugin, float], List[int]] = {}
+    for i, get_channel in enumerate(get_channels):
+        groups.setdefault((get_channel.plugin, get_channel.timeout), []).append(i)
+    results: List[Any] = [None] * len(get_channels)
+
+    async def load_group(plugin: Plugin, timeout: float, indexes: List[int]):
+        channels = await plugin.get_channels(
+            [get_channels[i].pv for i in indexes],
+            timeout,
+            [get_channels[i].config for i in indexes],
+        )
+        if len(channels) != len(indexes):
+            raise ValueError(
+                "%s plugin get_channels returned %d results for %d pvs"
+                % (plugin.transport, len(channels), len(indexes))
+            )
+        for i, channel in zip(indexes, channels):
+            results[i] = channel
+
+    await asyncio.gather(
+        *[
+            load_group(plugin, timeout, indexes)
+            for (plugin, timeout), indexes in groups.items()
+        ]
+    )
+    return results
 
 
 # Resolvers
-async def get_channel(id, timeout, ctx) -> DeferredChannel:
-    return GetChannel(id, timeout, ctx["store"])
+def get_channel(id, timeout, ctx, loader) -> DeferredChannel:
+    # Synchronous as the channel is only got when a field needs it
+    return GetChannel(id, timeout, ctx["store"], loader)
 
 
 async def channel_value(parent: DeferredChannel) -> Optional[ChannelValue]:
@@ -72,50 +183,107 @@ async def channel_value(parent: DeferredChannel) -> Optional[ChannelValue]:
     return channel.get_value()
 
 
-async def channel_value_float(parent: ChannelValue) -> Optional[float]:
-    return parent.formatter.to_float(parent.value)
+def channel_value_float(root: ChannelValue) -> Optional[float]:
+    # Synchronous as there is nothing to await
+    return root.formatter.to_float(root.value)
 
 
 async def subscribe_channel(id, ctx) -> AsyncIterator[Any]:
     store: PluginStore = ctx["store"]
     plugin, config, channel_id = store.plugin_config_id(id)
     # Remove the transport prefix from the read pv
-    pv = store.transport_pv(config.read_pv)[1]
-    async for channel in plugin.subscribe_channel(pv, config):
-        yield SubscribeChannel(channel_id, channel)
-        # yield dict(subscribeChannel=SubscribeChannel(channel_id, channel))
+    pv = store.read_transport_pv(config)[1]
+    # Prepare updates in a separate task so that the plugin is not held up while
+    # the previous update is being resolved and sent
+    # None marks the end of the updates
+    q: asyncio.Queue[Union[SubscribeChannel, Exception, None]] = asyncio.Queue(
+        maxsize=SUBSCRIBE_BUFFER_SIZE
+    )
+
+    async def prepare_updates():
+        try:
+            async for channel in plugin.subscribe_channel(pv, config):
+                await q.put(SubscribeChannel(channel_id, channel))
+        except Exception as e:
+            await q.put(e)
+        else:
+            await q.put(None)
+
+    task = asyncio.create_task(prepare_updates())
+    try:
+        while True:
+            update = await q.get()
+            if update is None:
+                return
+            elif isinstance(update, Exception):
+                raise update
+            yield update
+    finally:
+        task.cancel()
+        await asyncio.wait([task])
+
+
+# Put values longer than this are decoded in the default executor
+THREADED_DECODE_SIZE = 64 * 1024
+# First characters of a put value that need json decoding
+JSON_STARTS = frozenset("[{")
+# Number of numberTypes of base64 encoded arrays to cache dtypes for. Bounded as
+# clients can send any of numpy's unlimited number of dtype strings
+DTYPE_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=DTYPE_CACHE_SIZE)
+def number_type_dtype(number_type: str) -> np.dtype:
+    """Return the dtype for a lowercased numberType"""
+    return np.dtype(number_type)
+
+
+def decode_put_value(value: str) -> PutValue:
+    if value[:1] in JSON_STARTS:
+        # need to json decode
+        value = json_loads(value)
+        if isinstance(value, dict):
+            # decode base64 array
+            # Lowercase first so differently cased names share an entry
+            dtype = number_type_dtype(value["numberType"].lower())
+            # https://stackoverflow.com/a/6485943
+            value = np.frombuffer(a2b_base64(value["base64"]), dtype=dtype)
+    return value
 
 
 async def put_channel(
-    ids: List[str], put_values: List[str], timeout, ctx
+    ids: List[str], put_values: List[str], timeout, ctx, loader
 ) -> Sequence[DeferredChannel]:
     store: PluginStore = ctx["store"]
+    # Not asserts, as these must still be checked when running with -O
+    if len(put_values) != len(ids):
+        raise ValueError("Mismatch in ids and values length")
     pvs = []
     plugins = set()
-    for channel_id in ids:
-        plugin, config, channel_id = store.plugin_config_id(channel_id)
-        pv = config.write_pv
-        assert pv, f"{channel_id} is configured read-only"
+    for plugin, config, channel_id in map(store.plugin_config_id, ids):
+        if not config.write_pv:
+            raise ValueError(f"{channel_id} is configured read-only")
         plugins.add(plugin)
-        pvs.append(store.transport_pv(pv)[1])
+        pvs.append(store.write_transport_pv(config)[1])
+    if len(plugins) != 1:
+        raise ValueError(
+            "Can only put to pvs with the same transport, not %s"
+            % [p.transport for p in plugins]
+        )
+    loop = asyncio.get_running_loop()
     values = []
     for value in put_values:
-        if value[:1] in "[{":
-            # need to json decode
-            value = json.loads(value)
-            if isinstance(value, dict):
-                # decode base64 array
-                dtype = np.dtype(value["numberType"].lower())
-                value_b = base64.b64decode(value["base64"])
-                # https://stackoverflow.com/a/6485943
-                value = np.frombuffer(value_b, dtype=dtype)
-        values.append(value)
-    assert len(values) == len(pvs), "Mismatch in ids and values length"
-    assert len(plugins) == 1, "Can only put to pvs with the same transport, not %s" % [
-        p.transport for p in plugins
-    ]
+        if len(value) > THREADED_DECODE_SIZE:
+            # Large arrays are decoded in a thread so other clients aren't held up
+            values.append(await loop.run_in_executor(None, decode_put_value, value))
+        else:
+            values.append(decode_put_value(value))
     await plugins.pop().put_channels(pvs, values, timeout)
-    channels = [GetChannel(channel_id, timeout, store) for channel_id in ids]
+    # Don't share a get that started before the put, it may return the old value
+    scope = object()
+    channels = [
+        GetChannel(channel_id, timeout, store, loader, scope) for channel_id in ids
+    ]
     return channels
 
 
@@ -129,19 +297,21 @@ class Range:
 
 
 @strawberry.enum
-class ChannelQuality(Enum):
+class ChannelQuality(str, Enum):
+    # Values are the GraphQL names, so the quality strings from types.ChannelStatus
+    # serialize with a single dict lookup
     # "Value is known, valid, nothing is wrong"
-    VALID = auto()
+    VALID = "VALID"
     # "Value is known, valid, but is in the range generating a warning"
-    WARNING = auto()
+    WARNING = "WARNING"
     # "Value is known, valid, but is in the range generating an alarm condition"
-    ALARM = auto()
+    ALARM = "ALARM"
     # "Value is known, but not valid, e.g. a RW before its first put"
-    INVALID = auto()
+    INVALID = "INVALID"
     # "The value is unknown, for instance because the channel is disconnected"
-    UNDEFINED = auto()
+    UNDEFINED = "UNDEFINED"
     # "The Channel is currently in the process of being changed"
-    CHANGING = auto()
+    CHANGING = "CHANGING"
 
 
 @strawberry.type
@@ -153,9 +323,7 @@ class ChannelValue:
     #    units: bool = False) -> str
 
     # "The current value formatted as a Float, Null if not expressable"
-    @strawberry.field
-    def float(self) -> float:  # = strawberry.field(resolver=channel_value_float)
-        return channel_value_float(self)
+    float: float = strawberry.field(resolver=channel_value_float)
 
 
 @strawberry.type
@@ -194,6 +362,11 @@ class Channel:
     # "The current value of this channel"
     @strawberry.field
     def value(self) -> ChannelValue:
+        if isinstance(self, SubscribeChannel):
+            return self.value
+        if self.channel is not None:
+            # Already have the channel (e.g. a subscription), no need to await
+            return self.channel.get_value()
         return channel_value(self)
 
     # "When was the value last updated"
@@ -213,13 +386,81 @@ def make_context() -> Dict[str, Any]:
     return context
 
 
-context = make_context()
+# Built once at import and shared read-only by every request, so that the
+# plugins (and their connections) are not re-created per GraphQL operation
+context: Mapping[str, Any] = MappingProxyType(make_context())
+
+
+class BatchHTTPHandler(HTTPHandler):
+    """HTTP handler that also accepts a JSON list of operations in a single POST,
+    executing them concurrently with a shared context and returning a list of
+    results in the same order"""
+
+    async def post(self, request: web.Request) -> web.StreamResponse:
+        if request.content_type.startswith("multipart/form-data"):
+            return await super().post(request)
+        data = await self.parse_body(request)
+        if not isinstance(data, list):
+            return await self.execute_request(
+                request=request, request_data=self.parse_operation(data), method="POST"
+            )
+        if not data:
+            raise web.HTTPBadRequest(reason="Empty list of GraphQL operations")
+        operations = [self.parse_operation(op) for op in data]
+        response = web.Response()
+        context = await self.get_context(request, response)
+        root_value = await self.get_root_value(request)
+        allowed_operation_types = OperationType.from_http("POST")
+        try:
+            results = await asyncio.gather(
+                *[
+                    self.schema.execute(
+                        query=op.query,
+                        root_value=root_value,
+                        variable_values=op.variables,
+                        context_value=context,
+                        operation_name=op.operation_name,
+                        allowed_operation_types=allowed_operation_types,
+                    )
+                    for op in operations
+                ]
+            )
+        except InvalidOperationTypeError as e:
+            # As HTTPHandler.execute_request does for a single operation
+            raise web.HTTPBadRequest(
+                reason=e.as_http_error_reason(method="POST")
+            ) from e
+        response_data = [
+            await self.process_result(request, result) for result in results
+        ]
+        response.text = json.dumps(response_data)
+        response.content_type = "application/json"
+        return response
+
+    def parse_operation(self, data: Any) -> GraphQLRequestData:
+        if not isinstance(data, dict):
+            raise web.HTTPBadRequest(reason="GraphQL operation must be a JSON object")
+        try:
+            return parse_request_data(data)
+        except MissingQueryError as e:
+            raise web.HTTPBadRequest(
+                reason="No GraphQL query found in the request"
+            ) from e
 
 
 class MyGraphQLView(GraphQLView):
+    http_handler_class = BatchHTTPHandler
+
     async def get_context(self, request: web.Request, response: web.StreamResponse):
-        ctx = context
-        return {"request": request, "response": response, "ctx": ctx}
+        return {
+            "request": request,
+            "response": response,
+            "ctx": context,
+            # Per request, so only GetChannels from the same request are batched.
+            # No cache as keys are GetChannel instances, DeferredChannel.inflight
+            # already shares gets of the same channel
+            "loader": DataLoader(load_fn=load_channels, cache=False),
+        }
 
 
 @strawberry.type
@@ -229,7 +470,8 @@ class Query:
     def getChannel(
         self, info: Info, id: strawberry.ID, timeout: float = 5.0
     ) -> Channel:
-        return get_channel(id, timeout, info.context["ctx"])
+        context = info.context
+        return get_channel(id, timeout, context["ctx"], context["loader"])
 
 
 @strawberry.type
@@ -251,20 +493,69 @@ class Mutation:
         values: List[str],
         timeout: float = 5.0,
     ) -> List[Channel]:
-        return await put_channel(ids, values, timeout, info.context["ctx"])
-
-
-def main(args=None) -> None:
-    """
-    Entry point of the application.
-    """
-    parser = ArgumentParser(description="CONtrol system Interface over graphQL")
-    parser.add_argument(
-        "--cors", action="store_true", help="Allow CORS for all origins and routes"
-    )
-    parsed_args = parser.parse_args(args)
+        context = info.context
+        return await put_channel(
+            ids, values, timeout, context["ctx"], context["loader"]
+        )
+
+
+@web.middleware
+async def cors_preflight_middleware(
+    request: web.Request,
+    handler: Callable[[web.Request], Awaitable[web.StreamResponse]],
+) -> web.StreamResponse:
+    """Answer CORS preflight requests for any route, allowing everything"""
+    if (
+        request.method == "OPTIONS"
+        and "Origin" in request.headers
+        and "Access-Control-Request-Method" in request.headers
+    ):
+        return web.Response(
+            headers={
+                "Access-Control-Allow-Methods": request.headers[
+                    "Access-Control-Request-Method"
+                ],
+                "Access-Control-Allow-Headers": request.headers.get(
+                    "Access-Control-Request-Headers", ""
+                ),
+                "Access-Control-Max-Age": "3600",
+            }
+        )
+    return await handler(request)
+
+
+async def add_cors_headers(request: web.Request, response: web.StreamResponse):
+    """Allow any origin, with credentials, to read the response"""
+    origin = request.headers.get("Origin")
+    if origin is not None:
+        # Credentials are not allowed with "*" so echo the origin back
+        response.headers["Access-Control-Allow-Origin"] = origin
+        response.headers["Access-Control-Allow-Credentials"] = "true"
+        response.headers.add("Vary", "Origin")
+
+
+def install_event_loop(loop: str) -> None:
+    """Use uvloop for the event loop if requested (or installed for "auto")"""
+    if loop == "asyncio":
+        return
+    try:
+        import uvloop
+    except ImportError:
+        if loop == "uvloop":
+            raise
+    else:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def make_app(cors: bool = False) -> web.Application:
+    """Make the aiohttp Application serving the GraphQL schema"""
     schema = strawberry.Schema(
-        query=Query, subscription=Subscription, mutation=Mutation
+        query=Query,
+        subscription=Subscription,
+        mutation=Mutation,
+        # Repeated identical operations skip validation. Not ParserCache, as
+        # with it syntax errors escape as exceptions rather than GraphQL errors
+        extensions=[ValidationCache(maxsize=QUERY_CACHE_SIZE)],
     )
 
     view = MyGraphQLView(
@@ -277,15 +568,28 @@ def main(args=None) -> None:
     app.router.add_route("GET", "/ws", view)
     app.router.add_route("POST", "/graphql", view)
 
-    if parsed_args.cors:
+    if cors:
         # Enable CORS for all origins on all routes.
-        cors = aiohttp_cors.setup(app)
-        for route in app.router.routes():
-            allow_all = {
-                "*": aiohttp_cors.ResourceOptions(
-                    allow_headers=("*"), max_age=3600, allow_credentials=True
-                )
-            }
-            cors.add(route, allow_all)
+        app.middlewares.append(cors_preflight_middleware)
+        app.on_response_prepare.append(add_cors_headers)
+
+    return app
 
-    web.run_app(app)
+
+def main(args=None) -> None:
+    """
+    Entry point of the application.
+    """
+    parser = ArgumentParser(description="CONtrol system Interface over graphQL")
+    parser.add_argument(
+        "--cors", action="store_true", help="Allow CORS for all origins and routes"
+    )
+    parser.add_argument(
+        "--loop",
+        choices=("auto", "asyncio", "uvloop"),
+        default="auto",
+        help="Event loop to run the server on, auto uses uvloop if installed",
+    )
+    parsed_args = parser.parse_args(args)
+    install_event_loop(parsed_args.loop)
+    web.run_app(make_app(cors=parsed_args.cors))
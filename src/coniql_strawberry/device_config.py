@@ -1,8 +1,8 @@
 import re
 from pathlib import Path
-from typing import Dict, Iterator, Sequence, Union
+from typing import Dict, Iterator, Optional, Sequence, Tuple, Union
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 from ruamel.yaml import YAML
 
 from .coniql_schema import DisplayForm, Layout, Widget
@@ -55,6 +55,9 @@ class ChannelConfig(WithLabel):
         None,
         description="How should numeric values be displayed",
     )
+    # (transport, pv) of the pvs, filled in by PluginStore on first use
+    _read_transport_pv: Optional[Tuple[str, str]] = PrivateAttr(None)
+    _write_transport_pv: Optional[Tuple[str, str]] = PrivateAttr(None)
 
 
 class DeviceInstance(WithLabel):
@@ -1,6 +1,8 @@
+import asyncio
 import os
 from pathlib import Path
-from typing import AsyncIterator, Dict, List, Tuple, Union
+from types import MappingProxyType
+from typing import AsyncIterator, Dict, List, Mapping, Tuple, Union
 
 import numpy as np
 
@@ -9,6 +11,9 @@ from .types import Channel
 
 PutValue = Union[bool, int, float, str, List[str], np.ndarray]
 
+# Maximum number of channel ids to remember parsed results for
+LOOKUP_CACHE_SIZE = 4096
+
 
 class Plugin:
     transport: str
@@ -19,6 +24,17 @@ class Plugin:
         """Get the current structure of a Channel"""
         raise NotImplementedError(self)
 
+    async def get_channels(
+        self, pvs: List[str], timeout: float, configs: List[ChannelConfig]
+    ) -> List[Union[Channel, BaseException]]:
+        """Get the current structure of several Channels, with the exception
+        in place of each Channel that could not be got. Plugins that can get
+        many pvs in one request should override this"""
+        return await asyncio.gather(
+            *[self.get_channel(pv, timeout, c) for pv, c in zip(pvs, configs)],
+            return_exceptions=True,
+        )
+
     async def put_channels(
         self, pvs: List[str], values: List[PutValue], timeout: float
     ):
@@ -36,29 +52,69 @@ class Plugin:
 
 class PluginStore:
     def __init__(self):
-        # {transport: plugin}
-        self.plugins: Dict[str, Plugin] = {}
+        # {transport: plugin}, replaced rather than mutated so that readers
+        # never see it change underneath them
+        self.plugins: Mapping[str, Plugin] = MappingProxyType({})
         # {device_id: device_config}
         self.devices: Dict[str, DeviceConfig] = {}
         # {fully_qualified_channel_id: channel_config}
         self.channels: Dict[str, ChannelConfig] = {}
+        # {channel_id: (transport, pv)}
+        self._transport_pv_cache: Dict[str, Tuple[str, str]] = {}
+        # {channel_id: (plugin, channel_config, fully_qualified_channel_id)}
+        self._plugin_config_id_cache: Dict[str, Tuple[Plugin, ChannelConfig, str]] = {}
+
+    def _clear_caches(self):
+        self._transport_pv_cache.clear()
+        self._plugin_config_id_cache.clear()
+        # The default transport may have changed, so reparse configs' pvs
+        for config in self.channels.values():
+            config._read_transport_pv = None
+            config._write_transport_pv = None
 
     def add_plugin(self, transport: str, plugin: Plugin, set_default=False):
-        self.plugins[transport] = plugin
+        plugins = dict(self.plugins)
+        plugins[transport] = plugin
         plugin.transport = transport
         if set_default:
-            self.plugins[""] = plugin
+            plugins[""] = plugin
+        self.plugins = MappingProxyType(plugins)
+        self._clear_caches()
 
     def transport_pv(self, channel_id: str) -> Tuple[str, str]:
         """Take a channel_id with an optional transport prefix and
         return the transport and pv components"""
+        try:
+            return self._transport_pv_cache[channel_id]
+        except KeyError:
+            pass
         split = channel_id.split("://", 1)
         if len(split) == 1:
             transport, pv = self.plugins[""].transport, channel_id
         else:
             transport, pv = split
+        if len(self._transport_pv_cache) >= LOOKUP_CACHE_SIZE:
+            self._transport_pv_cache.clear()
+        self._transport_pv_cache[channel_id] = (transport, pv)
         return transport, pv
 
+    def read_transport_pv(self, config: ChannelConfig) -> Tuple[str, str]:
+        """Return the transport and pv components of the pv to read from,
+        which is the write pv if there is no read pv"""
+        transport_pv = config._read_transport_pv
+        if transport_pv is None:
+            transport_pv = self.transport_pv(config.read_pv or config.write_pv)
+            config._read_transport_pv = transport_pv
+        return transport_pv
+
+    def write_transport_pv(self, config: ChannelConfig) -> Tuple[str, str]:
+        """Return the transport and pv components of the pv to write to"""
+        transport_pv = config._write_transport_pv
+        if transport_pv is None:
+            transport_pv = self.transport_pv(config.write_pv)
+            config._write_transport_pv = transport_pv
+        return transport_pv
+
     def add_device_config(self, path: Path, device_id="", macros=None):
         """Load a top level .coniql.yaml file with devices in it"""
         device_config = DeviceConfig.from_yaml(path, macros)
@@ -73,6 +129,7 @@ class PluginStore:
                     # TODO: selectively update channel if already exists
                     transport, pv = self.transport_pv(child.write_pv or child.read_pv)
                     self.channels[f"{transport}://{pv}"] = child
+                    self._plugin_config_id_cache.clear()
                 elif isinstance(child, DeviceInstance):
                     # recursively load child devices
                     if child.id is None:
@@ -86,11 +143,21 @@ class PluginStore:
         return device_config
 
     def plugin_config_id(self, channel_id: str) -> Tuple[Plugin, ChannelConfig, str]:
+        try:
+            return self._plugin_config_id_cache[channel_id]
+        except KeyError:
+            pass
         transport, pv = self.transport_pv(channel_id)
-        channel_id = f"{transport}://{pv}"
+        fq_channel_id = f"{transport}://{pv}"
         plugin = self.plugins[transport]
-        config = self.channels.get(channel_id, None)
+        config = self.channels.get(fq_channel_id, None)
         if config is None:
             # None exists, make a RW config
-            config = ChannelConfig(name="", read_pv=channel_id, write_pv=channel_id)
-        return plugin, config, channel_id
+            config = ChannelConfig(
+                name="", read_pv=fq_channel_id, write_pv=fq_channel_id
+            )
+        if len(self._plugin_config_id_cache) >= LOOKUP_CACHE_SIZE:
+            self._plugin_config_id_cache.clear()
+        result = (plugin, config, fq_channel_id)
+        self._plugin_config_id_cache[channel_id] = result
+        return result
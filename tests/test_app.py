@@ -0,0 +1,251 @@
+import asyncio
+import base64
+import json
+from typing import AsyncIterator, List, Tuple, Union
+
+import numpy as np
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+from strawberry.dataloader import DataLoader
+
+from coniql_strawberry.app import (
+    DTYPE_CACHE_SIZE,
+    GetChannel,
+    context,
+    decode_put_value,
+    load_channels,
+    make_app,
+    number_type_dtype,
+    put_channel,
+    subscribe_channel,
+)
+from coniql_strawberry.device_config import ChannelConfig
+from coniql_strawberry.plugin import Plugin, PluginStore, PutValue
+from coniql_strawberry.types import Channel, ChannelValue
+
+
+class FakeChannel(Channel):
+    def __init__(self, value):
+        self.value = ChannelValue(value)
+
+    def get_value(self):
+        return self.value
+
+
+class FakePlugin(Plugin):
+    def __init__(self, values: List[float]):
+        self.values = values
+        self.gets = 0
+
+    async def get_channel(
+        self, pv: str, timeout: float, config: ChannelConfig
+    ) -> Channel:
+        self.gets += 1
+        value = self.values[0]
+        await asyncio.sleep(0.1)
+        return FakeChannel(value)
+
+    async def put_channels(
+        self, pvs: List[str], values: List[PutValue], timeout: float
+    ):
+        self.values[0] = values[0]
+
+    async def subscribe_channel(
+        self, pv: str, config: ChannelConfig
+    ) -> AsyncIterator[Channel]:
+        for value in self.values:
+            yield FakeChannel(value)
+
+
+def make_ctx(plugin: Plugin):
+    store = PluginStore()
+    store.add_plugin("fake", plugin, set_default=True)
+    return dict(store=store)
+
+
+async def test_subscribe_channel_ends_when_plugin_does():
+    ctx = make_ctx(FakePlugin([1.0, 2.0]))
+
+    async def collect():
+        return [update.value.value async for update in subscribe_channel("y", ctx)]
+
+    assert await asyncio.wait_for(collect(), 1) == [1.0, 2.0]
+
+
+async def test_cancelled_get_channel_does_not_cancel_others():
+    plugin = FakePlugin([1.0])
+    store = make_ctx(plugin)["store"]
+    first = GetChannel("y", 1.0, store, DataLoader(load_fn=load_channels))
+    second = GetChannel("y", 1.0, store, DataLoader(load_fn=load_channels))
+    first_task = asyncio.create_task(first.get_channel())
+    second_task = asyncio.create_task(second.get_channel())
+    await asyncio.sleep(0.01)
+    first_task.cancel()
+    channel = await asyncio.wait_for(second_task, 1)
+    assert channel.get_value().value == 1.0
+    assert plugin.gets == 1
+
+
+async def test_put_channel_does_not_share_get_started_before_put():
+    plugin = FakePlugin([1.0])
+    ctx = make_ctx(plugin)
+    loader = DataLoader(load_fn=load_channels, cache=False)
+    before = asyncio.create_task(
+        GetChannel("y", 1.0, ctx["store"], loader).get_channel()
+    )
+    await asyncio.sleep(0.01)
+    (after,) = await put_channel(["y"], ["5"], 1.0, ctx, loader)
+    assert (await after.get_channel()).get_value().value == "5"
+    assert (await before).get_value().value == 1.0
+
+
+async def test_get_channel_only_shared_with_same_timeout():
+    plugin = FakePlugin([1.0])
+    store = make_ctx(plugin)["store"]
+    await asyncio.gather(
+        *[
+            GetChannel(
+                "y", timeout, store, DataLoader(load_fn=load_channels)
+            ).get_channel()
+            for timeout in (0.5, 1.0, 1.0)
+        ]
+    )
+    assert plugin.gets == 2
+
+
+def test_decode_put_value_caches_dtypes_case_insensitively():
+    number_type_dtype.cache_clear()
+    array = np.arange(3, dtype=np.float64)
+    for number_type in ("FLOAT64", "Float64", "fLoAt64"):
+        value = decode_put_value(
+            json.dumps(
+                dict(
+                    numberType=number_type,
+                    base64=base64.b64encode(array.tobytes()).decode(),
+                )
+            )
+        )
+        assert np.array_equal(value, array)
+    assert number_type_dtype.cache_info().currsize == 1
+
+
+def test_dtype_cache_is_bounded():
+    for i in range(2 * DTYPE_CACHE_SIZE):
+        number_type_dtype(f"({i + 1},)u1")
+    assert number_type_dtype.cache_info().currsize == DTYPE_CACHE_SIZE
+
+
+async def test_syntax_error_is_a_graphql_error():
+    async with TestClient(TestServer(make_app())) as client:
+        resp = await client.post(
+            "/graphql", json={"query": '{ getChannel(id: "x") { id '}
+        )
+        assert resp.status == 200
+        result = await resp.json()
+    assert result["data"] is None
+    assert result["errors"][0]["message"].startswith("Syntax Error")
+
+
+GET_SINE = '{ getChannel(id: "ssim://sine") { value { float } } }'
+
+
+async def test_batched_operations_return_results_in_order():
+    async with TestClient(TestServer(make_app())) as client:
+        resp = await client.post(
+            "/graphql",
+            json=[{"query": "{ a: __typename }"}, {"query": "{ b: __typename }"}],
+        )
+        assert resp.status == 200
+        result = await resp.json()
+    assert result == [{"data": {"a": "Query"}}, {"data": {"b": "Query"}}]
+
+
+async def test_single_operation_is_not_batched():
+    async with TestClient(TestServer(make_app())) as client:
+        resp = await client.post("/graphql", json={"query": GET_SINE})
+        assert resp.status == 200
+        result = await resp.json()
+    assert result == {"data": {"getChannel": {"value": {"float": 0.0}}}}
+
+
+@pytest.mark.parametrize("body", [[], [1], [{"query": GET_SINE}, "x"], [{}]])
+async def test_bad_batch_is_bad_request(body):
+    async with TestClient(TestServer(make_app())) as client:
+        resp = await client.post("/graphql", json=body)
+        assert resp.status == 400
+
+
+class BulkPlugin(Plugin):
+    def __init__(self, short: bool = False):
+        self.calls: List[Tuple[List[str], float]] = []
+        self.short = short
+
+    async def get_channel(
+        self, pv: str, timeout: float, config: ChannelConfig
+    ) -> Channel:
+        if pv == "bad":
+            raise ValueError(pv)
+        return FakeChannel(pv)
+
+    async def get_channels(
+        self, pvs: List[str], timeout: float, configs: List[ChannelConfig]
+    ) -> List[Union[Channel, BaseException]]:
+        self.calls.append((pvs, timeout))
+        results = await super().get_channels(pvs, timeout, configs)
+        return results[1:] if self.short else results
+
+
+def make_bulk_store(*plugins: BulkPlugin) -> PluginStore:
+    store = PluginStore()
+    for i, plugin in enumerate(plugins):
+        store.add_plugin(f"p{i}", plugin)
+    return store
+
+
+async def test_load_channels_one_call_per_plugin_and_timeout():
+    p0, p1 = BulkPlugin(), BulkPlugin()
+    store = make_bulk_store(p0, p1)
+    ids_timeouts = [("p0://a", 1), ("p1://b", 1), ("p0://c", 1), ("p0://d", 2)]
+    results = await load_channels(
+        [GetChannel(id, timeout, store, None) for id, timeout in ids_timeouts]
+    )
+    assert [r.get_value().value for r in results] == ["a", "b", "c", "d"]
+    assert p0.calls == [(["a", "c"], 1), (["d"], 2)]
+    assert p1.calls == [(["b"], 1)]
+
+
+async def test_load_channels_failing_pv_only_fails_itself():
+    store = make_bulk_store(BulkPlugin())
+    results = await load_channels(
+        [GetChannel(f"p0://{pv}", 1, store, None) for pv in ("a", "bad", "c")]
+    )
+    assert results[0].get_value().value == "a"
+    assert isinstance(results[1], ValueError)
+    assert results[2].get_value().value == "c"
+
+
+async def test_load_channels_checks_number_of_results():
+    store = make_bulk_store(BulkPlugin(short=True))
+    with pytest.raises(ValueError, match="returned 1 results for 2 pvs"):
+        await load_channels([GetChannel(f"p0://{pv}", 1, store, None) for pv in "ab"])
+
+
+async def test_query_batches_gets_per_plugin_and_timeout(monkeypatch):
+    sim = context["store"].plugins["ssim"]
+    calls = []
+    get_channels = sim.get_channels
+
+    async def spy(pvs, timeout, configs):
+        calls.append((pvs, timeout))
+        return await get_channels(pvs, timeout, configs)
+
+    monkeypatch.setattr(sim, "get_channels", spy)
+    query = """{
+        a: getChannel(id: "ssim://sine") { value { float } }
+        b: getChannel(id: "ssim://rampwave") { value { float } }
+        c: getChannel(id: "ssim://sinewave", timeout: 1) { value { float } }
+    }"""
+    async with TestClient(TestServer(make_app())) as client:
+        resp = await client.post("/graphql", json={"query": query})
+        assert resp.status == 200
+    assert sorted(calls) == [(["sine", "rampwave"], 5.0), (["sinewave"], 1.0)]
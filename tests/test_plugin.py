@@ -0,0 +1,14 @@
+from coniql_strawberry.device_config import ChannelConfig
+from coniql_strawberry.plugin import Plugin, PluginStore
+
+
+def test_add_plugin_clears_cached_config_pvs():
+    store = PluginStore()
+    store.add_plugin("a", Plugin(), set_default=True)
+    config = ChannelConfig(name="", read_pv="x", write_pv="y")
+    store.channels["a://x"] = config
+    assert store.read_transport_pv(config) == ("a", "x")
+    assert store.write_transport_pv(config) == ("a", "y")
+    store.add_plugin("b", Plugin(), set_default=True)
+    assert store.read_transport_pv(config) == ("b", "x")
+    assert store.write_transport_pv(config) == ("b", "y")